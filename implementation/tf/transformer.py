@@ -1,6 +1,10 @@
 import tensorflow as tf
 import time
+import csv
+import itertools
+import math
 import numpy as np
+import pandas as pd
 from reader import *
 import os
 import warnings
@@ -14,37 +18,34 @@ except ImportError:
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
+# run the matmuls in float16 on GPUs (tensor cores), variables stay in float32
+if tf.config.list_physical_devices('GPU'):
+    tf.keras.mixed_precision.set_global_policy('mixed_float16')
 
-def get_angles(pos, i, d_model):
-  angle_rates = 1 / np.power(10000, (2 * (i//2)) / np.float32(d_model))
-  return pos * angle_rates
 
+def positional_encoding(position, d_model, dtype=tf.float32):
+    # angles are computed only for the (sin, cos) pairs, i.e. for the even indices 2i
+    i = np.arange((d_model + 1) // 2)
+    angle_rates = 1 / np.power(10000, 2 * i / np.float32(d_model))
+    angle_rads = np.arange(position)[:, np.newaxis] * angle_rates[np.newaxis, :]
 
-def positional_encoding(position, d_model):
-    angle_rads = get_angles(np.arange(position)[:, np.newaxis],
-                            np.arange(d_model)[np.newaxis, :],
-                            d_model)
+    pos_encoding = np.empty((position, d_model), dtype=np.float32)
+    pos_encoding[:, 0::2] = np.sin(angle_rads)  # 2i
+    pos_encoding[:, 1::2] = np.cos(angle_rads[:, :d_model // 2])  # 2i+1
 
-    # apply sin to even indices in the array; 2i
-    angle_rads[:, 0::2] = np.sin(angle_rads[:, 0::2])
-
-    # apply cos to odd indices in the array; 2i+1
-    angle_rads[:, 1::2] = np.cos(angle_rads[:, 1::2])
-
-    pos_encoding = angle_rads[np.newaxis, ...]
-
-    return tf.cast(pos_encoding, dtype=tf.float32)
+    return tf.constant(pos_encoding[np.newaxis, ...], dtype=dtype)
 
 
 def scaled_dot_product_attention(q, k, v, mask):
     """Calculate the attention weights.
+    q must already be scaled by 1/sqrt(depth).
     q, k, v must have matching leading dimensions.
     k, v must have matching penultimate dimension, i.e.: seq_len_k = seq_len_v.
     The mask has different shapes depending on its type(padding or look ahead)
     but it must be broadcastable for addition.
 
     Args:
-      q: query shape == (..., seq_len_q, depth)
+      q: scaled query shape == (..., seq_len_q, depth)
       k: key shape == (..., seq_len_k, depth)
       v: value shape == (..., seq_len_v, depth_v)
       mask: Float tensor with shape broadcastable
@@ -54,15 +55,14 @@ def scaled_dot_product_attention(q, k, v, mask):
       output, attention_weights
     """
 
-    matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
-
-    # scale matmul_qk
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+    scaled_attention_logits = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
 
     # add the mask to the scaled tensor.
+    # (-1e9 does not fit into float16, use the smallest finite value instead)
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        dtype = scaled_attention_logits.dtype
+        large_negative = -1e9 if dtype == tf.float32 else tf.float16.min
+        scaled_attention_logits += tf.cast(mask, dtype) * large_negative
 
         # softmax is normalized on the last axis (seq_len_k) so that the scores
     # add up to 1.
@@ -93,8 +93,8 @@ def create_masks(inp, tar):
     enc_padding_mask = create_padding_mask(inp)
 
     # Used in the 2nd attention block in the decoder.
-    # This padding mask is used to mask the encoder outputs.
-    dec_padding_mask = create_padding_mask(inp)
+    # This padding mask is used to mask the encoder outputs, i.e. it is the encoder padding mask.
+    dec_padding_mask = enc_padding_mask
 
     # Used in the 1st attention block in the decoder.
     # It is used to pad and mask future tokens in the input received by
@@ -115,52 +115,125 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         assert d_model % self.num_heads == 0
 
         self.depth = d_model // self.num_heads
+        self.inv_sqrt_depth = 1.0 / math.sqrt(self.depth)
 
+        # self-attention projects q, k and v with one fused GEMM, cross-attention
+        # projects the query separately and fuses only k and v
+        # (only the projections that are actually used get built)
+        self.w_qkv = tf.keras.layers.Dense(3 * d_model)
         self.wq = tf.keras.layers.Dense(d_model)
-        self.wk = tf.keras.layers.Dense(d_model)
-        self.wv = tf.keras.layers.Dense(d_model)
+        self.w_kv = tf.keras.layers.Dense(2 * d_model)
 
         self.dense = tf.keras.layers.Dense(d_model)
 
-    def split_heads(self, x, batch_size):
-        """Split the last dimension into (num_heads, depth).
-        Transpose the result such that the shape is (batch_size, num_heads, seq_len, depth)
+    def project_heads(self, dense, x, num_projections=1):
+        """Apply the projection(s) of `dense` to x and produce them directly in head-major order,
+        i.e. with the kernel of shape (d_model, num_projections * d_model) viewed as
+        (d_model, num_projections, num_heads, depth), so that no transpose of the result is needed.
+
+        Returns:
+          list of num_projections tensors of shape (batch_size, num_heads, seq_len, depth)
         """
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+        if not dense.built:
+            dense.build(x.shape)
+        kernel = tf.reshape(tf.cast(dense.kernel, x.dtype),
+                            (self.d_model, num_projections, self.num_heads, self.depth))
+        bias = tf.reshape(tf.cast(dense.bias, x.dtype), (num_projections, 1, self.num_heads, 1, self.depth))
+        projections = tf.einsum('bld,dnhe->nbhle', x, kernel) + bias
+        return tf.unstack(projections, num_projections)
 
     def call(self, v, k, q, mask):
-        batch_size = tf.shape(q)[0]
+        if v is k is q:
+            q, k, v = self.project_heads(self.w_qkv, q, 3)  # 3 x (batch_size, num_heads, seq_len, depth)
+        else:
+            q, = self.project_heads(self.wq, q)  # (batch_size, num_heads, seq_len_q, depth)
+            if v is k:
+                k, v = self.project_heads(self.w_kv, k, 2)  # 2 x (batch_size, num_heads, seq_len_k, depth)
+            else:
+                k = self.project_heads(self.w_kv, k, 2)[0]
+                v = self.project_heads(self.w_kv, v, 2)[1]
+
+        return self._attend(q, k, v, mask)
+
+    def project_memory(self, memory):
+        """Project keys and values of a sequence attended to by every decoding step
+        (the encoder output), so that they are computed only once per decoded sequence.
+        """
+        k, v = self.project_heads(self.w_kv, memory, 2)
+        return k, v
+
+    def self_attention_step(self, x, mask, cache, position):
+        """Self-attention of a single decoding step.
+        The keys and values of x are written to the cache at `position`, the query
+        attends to all cached positions (the mask hides those not decoded yet).
 
-        q = self.wq(q)  # (batch_size, seq_len, d_model)
-        k = self.wk(k)  # (batch_size, seq_len, d_model)
-        v = self.wv(v)  # (batch_size, seq_len, d_model)
+        Args:
+          x: shape == (batch_size, 1, d_model)
+          cache: (k, v), each of shape == (batch_size, num_heads, max_len, depth)
+          position: index of x in the decoded sequence
 
-        q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+        Returns:
+          output, attention_weights, updated cache
+        """
+        q, k, v = self.project_heads(self.w_qkv, x, 3)  # 3 x (batch_size, num_heads, 1, depth)
+
+        cache_k, cache_v = cache
+        at_position = tf.equal(tf.range(tf.shape(cache_k)[2]), position)[:, tf.newaxis]  # (max_len, 1)
+        cache_k = tf.where(at_position, k, cache_k)
+        cache_v = tf.where(at_position, v, cache_v)
+
+        output, attention_weights, _ = self._attend(q, cache_k, cache_v, mask)
+        return output, attention_weights, (cache_k, cache_v)
+
+    def cross_attention_step(self, x, memory, mask):
+        """Attention of a single decoding step over memory projected by `project_memory`."""
+        q, = self.project_heads(self.wq, x)  # (batch_size, num_heads, 1, depth)
+        k, v = memory
+        return self._attend(q, k, v, mask)
+
+    def _attend(self, q, k, v, mask):
+        # attention only runs inside the jit-compiled SeqModel.train_step and SeqModel._generate,
+        # so XLA already fuses the query projection into QK^T and the softmax into the product with v
+        # within one cluster; a nested jit-compiled helper here would be inlined into it anyway.
+        # scaling q by a Python constant is cheaper than scaling the (seq_len_q, seq_len_k) logits
+        q *= self.inv_sqrt_depth
 
         # scaled_attention.shape == (batch_size, num_heads, seq_len_q, depth)
         # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
         scaled_attention, attention_weights = scaled_dot_product_attention(
             q, k, v, mask)
 
-        scaled_attention = tf.transpose(scaled_attention,
-                                        perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
+        # the output projection contracts heads and depth directly, with the kernel viewed as
+        # (num_heads, depth, d_model), instead of transposing the heads back first
+        if not self.dense.built:
+            self.dense.build(tf.TensorShape([None, self.d_model]))
+        kernel = tf.reshape(tf.cast(self.dense.kernel, scaled_attention.dtype),
+                            (self.num_heads, self.depth, self.d_model))
+        output = tf.einsum('bhle,hed->bld', scaled_attention, kernel) + \
+            tf.cast(self.dense.bias, scaled_attention.dtype)  # (batch_size, seq_len_q, d_model)
 
-        concat_attention = tf.reshape(scaled_attention,
-                                      (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
+        return output, attention_weights, scaled_attention
 
-        output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
 
-        return output, attention_weights, scaled_attention
+class PointwiseFFN(tf.keras.layers.Layer):
+    """Position-wise feed-forward network relu(x W1 + b1) W2 + b2 with explicit weights,
+    so that XLA can fuse the bias add and the relu into the surrounding matmuls.
+    """
+    def __init__(self, d_model, dff, **kwargs):
+        super(PointwiseFFN, self).__init__(**kwargs)
+        self.d_model = d_model
+        self.dff = dff
 
+    def build(self, input_shape):
+        self.w1 = self.add_weight('w1', shape=(self.d_model, self.dff), initializer='glorot_uniform')
+        self.b1 = self.add_weight('b1', shape=(self.dff,), initializer='zeros')
+        self.w2 = self.add_weight('w2', shape=(self.dff, self.d_model), initializer='glorot_uniform')
+        self.b2 = self.add_weight('b2', shape=(self.d_model,), initializer='zeros')
+        super(PointwiseFFN, self).build(input_shape)
 
-def point_wise_feed_forward_network(d_model, dff):
-  return tf.keras.Sequential([
-      tf.keras.layers.Dense(dff, activation='relu', input_shape=(None, d_model)),  # (batch_size, seq_len, dff)
-      tf.keras.layers.Dense(d_model)  # (batch_size, seq_len, d_model)
-  ])
+    def call(self, x):
+        y = tf.nn.relu(tf.nn.bias_add(tf.matmul(x, self.w1), self.b1))  # (batch_size, seq_len, dff)
+        return tf.nn.bias_add(tf.matmul(y, self.w2), self.b2)  # (batch_size, seq_len, d_model)
 
 
 def read_embeddings(reader, embeddings_file="data/glove.6B.{}d.txt", embedding_size=50):
@@ -172,12 +245,12 @@ def read_embeddings(reader, embeddings_file="data/glove.6B.{}d.txt", embedding_s
     vocab_to_index = {reader.vocab.decode(id): id for id in range(cfg.vocab_size)}
     embedding_matrix = np.zeros((cfg.vocab_size + 1, embedding_size))
     embeddings_file = embeddings_file.format(embedding_size)
-    with open(embeddings_file) as infile:
-        for line in infile:
-            word, coeffs = line.split(maxsplit=1)
-            if word in vocab_to_index:
-                word_index = vocab_to_index[word]
-                embedding_matrix[word_index] = np.fromstring(coeffs, 'f', sep=' ')
+    # parse the whole file with the C parser, words such as "null" or '"' must stay as they are
+    column_types = {0: str, **{column: np.float32 for column in range(1, embedding_size + 1)}}
+    embeddings = pd.read_csv(embeddings_file, sep=' ', header=None, index_col=0, dtype=column_types,
+                             quoting=csv.QUOTE_NONE, na_filter=False, engine='c')
+    hits = embeddings[embeddings.index.isin(vocab_to_index.keys())]
+    embedding_matrix[[vocab_to_index[word] for word in hits.index]] = hits.values
 
     return embedding_matrix
 
@@ -187,7 +260,7 @@ class EncoderLayer(tf.keras.layers.Layer):
         super(EncoderLayer, self).__init__()
 
         self.mha = MultiHeadAttention(d_model, num_heads)
-        self.ffn = point_wise_feed_forward_network(d_model, dff)
+        self.ffn = PointwiseFFN(d_model, dff)
 
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
         self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -214,7 +287,7 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.mha1 = MultiHeadAttention(d_model, num_heads)
         self.mha2 = MultiHeadAttention(d_model, num_heads)
 
-        self.ffn = point_wise_feed_forward_network(d_model, dff)
+        self.ffn = PointwiseFFN(d_model, dff)
 
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
         self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -243,6 +316,29 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out3, attn_weights_block1, attn_weights_block2, attn2
 
+    def step(self, x, memory, cache, position, look_ahead_mask, padding_mask):
+        """Decode a single position (inference only, so there is no dropout).
+
+        Args:
+          x: shape == (batch_size, 1, d_model)
+          memory: encoder output projected by `self.mha2.project_memory`
+          cache: self-attention (k, v) cache of this layer
+          position: index of x in the decoded sequence
+
+        Returns:
+          output, updated cache
+        """
+        attn1, _, cache = self.mha1.self_attention_step(x, look_ahead_mask, cache, position)
+        out1 = self.layernorm1(attn1 + x)
+
+        attn2, _, _ = self.mha2.cross_attention_step(out1, memory, padding_mask)
+        out2 = self.layernorm2(attn2 + out1)
+
+        ffn_output = self.ffn(out2)
+        out3 = self.layernorm3(ffn_output + out2)  # (batch_size, 1, d_model)
+
+        return out3, cache
+
 
 class Encoder(tf.keras.layers.Layer):
     def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
@@ -259,7 +355,7 @@ class Encoder(tf.keras.layers.Layer):
             self.embedding = tf.keras.layers.Embedding(input_vocab_size, d_model)
 
         self.pos_encoding = positional_encoding(maximum_position_encoding,
-                                                self.d_model)
+                                                self.d_model, self.compute_dtype)
 
         self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate)
                            for _ in range(num_layers)]
@@ -271,7 +367,7 @@ class Encoder(tf.keras.layers.Layer):
 
         # adding embedding and position encoding.
         x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
         x += self.pos_encoding[:, :seq_len, :]
 
         x = self.dropout(x, training=training)
@@ -297,7 +393,7 @@ class Decoder(tf.keras.layers.Layer):
         else:
             self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
 
-        self.pos_encoding = positional_encoding(maximum_position_encoding, d_model)
+        self.pos_encoding = positional_encoding(maximum_position_encoding, d_model, self.compute_dtype)
 
         self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate)
                            for _ in range(num_layers)]
@@ -315,7 +411,7 @@ class Decoder(tf.keras.layers.Layer):
         attention_weights = {}
 
         x = self.embedding(x)  # (batch_size, target_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
         x += self.pos_encoding[:, :seq_len, :]
 
         x = self.dropout(x, training=training)
@@ -328,37 +424,91 @@ class Decoder(tf.keras.layers.Layer):
             attention_weights['decoder_layer{}_block2'.format(i + 1)] = block2
 
         if self.copynet:
-            p_gen = self.gen_prob(x)
-            copy_distributions = []
-            for dec_token in tf.unstack(x, axis=1):
-                to_concat = tf.tile(tf.expand_dims(dec_token, 1), [1,enc_output.shape[1], 1])
-                copynet_input = tf.concat([enc_output, to_concat], axis=-1)
-                copy_distribution = self.copy_network(copynet_input)
-                try:
-                    copy_distribution = tf.squeeze(copy_distribution, axis=1)
-                except tf.errors.InvalidArgumentError:
-                    copy_distribution = tf.squeeze(copy_distribution)
-                copy_probs = tf.nn.softmax(copy_distribution)
-                if copy_probs.shape.ndims == 1:
-                    copy_probs = tf.expand_dims(copy_probs, axis=0)
-                i1, i2 = tf.meshgrid(tf.range(inp.shape[0]),
-                                     tf.range(inp.shape[1]), indexing="ij")
-                i1 = tf.tile(i1[:, :, tf.newaxis], [1, 1, 1])
-                i2 = tf.tile(i2[:, :, tf.newaxis], [1, 1, 1])
-                # Create final indices
-                idx = tf.stack([i1, i2, tf.expand_dims(inp, axis=2)], axis=-1)
-                # Output shape
-                to_shape = [inp.shape[0], inp.shape[1], self.target_vocab_size]
-                # Get scattered tensor
-                output = tf.scatter_nd(idx, tf.expand_dims(copy_probs, axis=2), to_shape)
-                copy_logits = tf.reduce_sum(output, axis=1)
-                copy_distributions.append(copy_logits)
-            copy_distributions = tf.stack(copy_distributions, axis=1)
-
+            p_gen, copy_distributions = self._copy_distributions(x, enc_output, inp)
             return x, attention_weights, p_gen, copy_distributions
         else:
-            p_gen = 0.
-            return x, attention_weights, p_gen, 0.
+            # without copynet the output is the generated distribution alone, nothing to mix in
+            return x, attention_weights, None, None
+
+    def project_memory(self, enc_output):
+        """Cross-attention keys and values of every layer, shared by all decoding steps."""
+        return [dec_layer.mha2.project_memory(enc_output) for dec_layer in self.dec_layers]
+
+    def initial_cache(self, batch_size, max_len):
+        """Empty self-attention (k, v) caches of every layer for decoding up to max_len positions."""
+        mha = self.dec_layers[0].mha1
+        zeros = tf.zeros([batch_size, mha.num_heads, max_len, mha.depth], dtype=self.compute_dtype)
+        return [(zeros, zeros) for _ in range(self.num_layers)]
+
+    def step(self, x, position, enc_output, memory, cache, look_ahead_mask, padding_mask, inp):
+        """Decode the token at `position` given the caches of all the previous positions.
+
+        Args:
+          x: token ids, shape == (batch_size, 1)
+          memory: output of `project_memory`
+          cache: output of `initial_cache` or of the previous step
+
+        Returns:
+          output, p_gen, copy_distributions (both None without copynet), updated cache
+        """
+        x = self.embedding(x)  # (batch_size, 1, d_model)
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x += tf.slice(self.pos_encoding, [0, position, 0], [-1, 1, -1])
+
+        new_cache = []
+        for dec_layer, layer_memory, layer_cache in zip(self.dec_layers, memory, cache):
+            x, layer_cache = dec_layer.step(x, layer_memory, layer_cache, position, look_ahead_mask, padding_mask)
+            new_cache.append(layer_cache)
+
+        if self.copynet:
+            p_gen, copy_distributions = self._copy_distributions(x, enc_output, inp)
+            return x, p_gen, copy_distributions, new_cache
+        else:
+            return x, None, None, new_cache
+
+    def _copy_distributions(self, x, enc_output, inp):
+        p_gen = self.gen_prob(x)
+        batch_size, tar_len, inp_len = tf.shape(x)[0], tf.shape(x)[1], tf.shape(enc_output)[1]
+
+        # pair every decoder position with every encoder position in one pass
+        # instead of looping over the (possibly unknown) target length
+        enc_tiled = tf.tile(tf.expand_dims(enc_output, 1), [1, tar_len, 1, 1])  # (batch, tar_len, inp_len, d_model)
+        dec_tiled = tf.tile(tf.expand_dims(x, 2), [1, 1, inp_len, 1])  # (batch, tar_len, inp_len, d_model)
+        copynet_input = tf.reshape(tf.concat([enc_tiled, dec_tiled], axis=-1),
+                                   [batch_size, -1, 2 * self.d_model])
+        copy_distribution = tf.reshape(self.copy_network(copynet_input), [batch_size, tar_len, inp_len])
+        # never copy the padding (same masking as in scaled_dot_product_attention)
+        dtype = copy_distribution.dtype
+        large_negative = -1e9 if dtype == tf.float32 else tf.float16.min
+        copy_distribution += tf.cast(tf.math.equal(inp, 0), dtype)[:, tf.newaxis, :] * large_negative
+        copy_probs = tf.nn.softmax(copy_distribution)  # (batch, tar_len, inp_len)
+
+        # sum the probabilities of every input token into its (batch, vocab) slot
+        batch_offsets = tf.range(batch_size)[:, tf.newaxis] * self.target_vocab_size
+        segment_ids = inp + batch_offsets  # (batch, inp_len)
+        copy_logits = tf.math.unsorted_segment_sum(tf.transpose(copy_probs, [0, 2, 1]), segment_ids,
+                                                   batch_size * self.target_vocab_size)  # (batch * vocab, tar_len)
+        copy_logits = tf.reshape(copy_logits, [batch_size, self.target_vocab_size, tar_len])
+        copy_distributions = tf.transpose(copy_logits, [0, 2, 1])  # (batch, tar_len, target_vocab_size)
+
+        return p_gen, copy_distributions
+
+
+class TiedOutputProjection(tf.keras.layers.Layer):
+    """Projects decoder outputs to vocabulary logits with the (transposed) weights of the
+    decoder input embedding, so that only a bias is learned on top of the embedding matrix.
+    """
+    def __init__(self, embedding, **kwargs):
+        super(TiedOutputProjection, self).__init__(**kwargs)
+        self.embedding = embedding
+
+    def build(self, input_shape):
+        self.bias = self.add_weight('bias', shape=(self.embedding.input_dim,), initializer='zeros')
+        super(TiedOutputProjection, self).build(input_shape)
+
+    def call(self, x):
+        embeddings = tf.cast(self.embedding.embeddings, x.dtype)  # (target_vocab_size, d_model)
+        return tf.matmul(x, embeddings, transpose_b=True) + self.bias  # (..., target_vocab_size)
 
 
 class Transformer(tf.keras.Model):
@@ -377,34 +527,69 @@ class Transformer(tf.keras.Model):
         self.bspan_decoder = Decoder(num_layers, d_model, num_heads, dff,
                                target_vocab_size, pe_target, rate, copynet, embeddings_matrix)
 
-        self.response_final = tf.keras.layers.Dense(target_vocab_size)
-        self.bspan_final = tf.keras.layers.Dense(target_vocab_size)
+        # logits are kept in float32 so that the softmax and the loss are numerically stable
+        self.response_final = TiedOutputProjection(self.response_decoder.embedding, dtype='float32')
+        self.bspan_final = TiedOutputProjection(self.bspan_decoder.embedding, dtype='float32')
 
     def bspan(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
         enc_output, enc_attn = self.encoder(inp, training, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
 
-        # dec_output.shape == (batch_size, tar_seq_len, d_model)
-        dec_output, attention_weights, p_gen, copy_distributions = self.bspan_decoder(
-            tar, enc_output, training, look_ahead_mask, dec_padding_mask, enc_attn, inp)
-
-        bspan_output = self.response_final(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
-        if self.copynet:
-            bspan_output = p_gen * bspan_output + (1-p_gen) * copy_distributions
-
-        return bspan_output, attention_weights
+        return self._decode(self.bspan_decoder, inp, tar, enc_output, enc_attn, training,
+                            look_ahead_mask, dec_padding_mask)
 
     def response(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
         enc_output, enc_attn = self.encoder(inp, training, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
 
+        return self._decode(self.response_decoder, inp, tar, enc_output, enc_attn, training,
+                            look_ahead_mask, dec_padding_mask)
+
+    def call_both(self, bspan_inp, bspan_tar, response_inp, response_tar, training):
+        """Run the bspan and the response step within a single forward pass, each
+        encoding its own input.
+
+        Returns:
+          bspan_output, response_output
+        """
+        bspan_enc_padding_mask, bspan_combined_mask, bspan_dec_padding_mask = create_masks(bspan_inp, bspan_tar)
+        enc_output, enc_attn = self.encoder(bspan_inp, training, bspan_enc_padding_mask)
+        bspan_output, _ = self._decode(self.bspan_decoder, bspan_inp, bspan_tar, enc_output, enc_attn, training,
+                                       bspan_combined_mask, bspan_dec_padding_mask)
+
+        response_enc_padding_mask, response_combined_mask, response_dec_padding_mask = create_masks(
+            response_inp, response_tar)
+        enc_output, enc_attn = self.encoder(response_inp, training, response_enc_padding_mask)
+        response_output, _ = self._decode(self.response_decoder, response_inp, response_tar, enc_output, enc_attn,
+                                          training, response_combined_mask, response_dec_padding_mask)
+
+        return bspan_output, response_output
+
+    def _decode(self, decoder, inp, tar, enc_output, enc_attn, training, look_ahead_mask, dec_padding_mask):
         # dec_output.shape == (batch_size, tar_seq_len, d_model)
-        dec_output, attention_weights, p_gen, copy_distributions = self.response_decoder(
+        dec_output, attention_weights, p_gen, copy_distributions = decoder(
             tar, enc_output, training, look_ahead_mask, dec_padding_mask, enc_attn, inp)
 
-        response_output = self.response_final(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
+        return self._output_distribution(decoder, dec_output, p_gen, copy_distributions), attention_weights
+
+    def decode_step(self, decoder, inp, tar, position, enc_output, memory, cache, look_ahead_mask, dec_padding_mask):
+        """Decode a single position with `decoder` (one of bspan_decoder, response_decoder),
+        see `Decoder.step`.
+
+        Returns:
+          output of shape (batch_size, 1, target_vocab_size), updated cache
+        """
+        dec_output, p_gen, copy_distributions, cache = decoder.step(
+            tar, position, enc_output, memory, cache, look_ahead_mask, dec_padding_mask, inp)
+
+        return self._output_distribution(decoder, dec_output, p_gen, copy_distributions), cache
+
+    def _output_distribution(self, decoder, dec_output, p_gen, copy_distributions):
+        final = self.bspan_final if decoder is self.bspan_decoder else self.response_final
+        output = final(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
         if self.copynet:
-            response_output = p_gen * response_output + (1-p_gen) * copy_distributions
+            p_gen, copy_distributions = tf.cast(p_gen, tf.float32), tf.cast(copy_distributions, tf.float32)
+            output = p_gen * output + (1-p_gen) * copy_distributions
 
-        return response_output, attention_weights
+        return output
 
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
@@ -423,41 +608,60 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
         return tf.math.rsqrt(self.d_model) * tf.math.minimum(arg1, arg2)
 
 
-loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
-    from_logits=True, reduction='none')
+def loss_function(real, pred):
+    """Mean cross entropy of the logits pred over the non-padding positions of real."""
+    mask = tf.cast(tf.math.not_equal(real, 0), dtype=pred.dtype)
+    loss_ = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=real, logits=pred)
+
+    return tf.math.divide_no_nan(tf.reduce_sum(loss_ * mask), tf.reduce_sum(mask))
 
 
-def loss_function(real, pred):
-    mask = tf.math.logical_not(tf.math.equal(real, 0))
-    loss_ = loss_object(real, pred)
+# sequence lengths are padded up to a multiple of this, so that batches of similar lengths share
+# one XLA compiled kernel and the matmul shapes align with the float16 tensor core tiles
+PAD_MULTIPLE = 8
 
-    mask = tf.cast(mask, dtype=loss_.dtype)
-    loss_ *= mask
 
-    return tf.reduce_sum(loss_) / tf.reduce_sum(mask)
+def padded_length(length):
+    return -(-length // PAD_MULTIPLE) * PAD_MULTIPLE
 
 
 def tensorize(id_lists):
-    tensorized = tf.ragged.constant([x for x in id_lists]).to_tensor()
+    """Pad decoder targets (id lists starting with the start symbol) into an int32 tensor.
+    The targets are shifted by one in the train step, so the width is padded to one more than a
+    multiple of PAD_MULTIPLE.
+    """
+    width = 1 + padded_length(max(len(x) for x in id_lists) - 1)
+    tensorized = tf.ragged.constant([x for x in id_lists]).to_tensor(shape=[len(id_lists), width])
     return tf.cast(tensorized, dtype=tf.int32)
 
 
-# TODO change these functions so that they can take tensor input and not just list
+def concat_with_start_symbol(*fields):
+    """Concatenate the per-sample id lists of all fields behind a start symbol and pad the result
+    to a multiple of PAD_MULTIPLE.
+
+    Each field is a list (over the batch) of id lists. Every field is flattened into one int32
+    array and scattered into a preallocated padded buffer at offsets computed from the row
+    lengths, so the only per-sample Python work is reading the lists.
+    """
+    batch_size = len(fields[0])
+    lengths = np.array([[len(row) for row in field] for field in fields], dtype=np.int32)  # (num_fields, batch_size)
+    offsets = 1 + np.cumsum(lengths, axis=0) - lengths  # column of the first id of each field, per row
+    output = np.zeros((batch_size, padded_length(1 + lengths.sum(axis=0).max())), dtype=np.int32)
+    output[:, 0] = cfg.vocab_size
+    for field, field_lengths, field_offsets in zip(fields, lengths, offsets):
+        ids = np.fromiter(itertools.chain.from_iterable(field), dtype=np.int32, count=field_lengths.sum())
+        rows = np.repeat(np.arange(batch_size), field_lengths)
+        row_starts = np.repeat(np.cumsum(field_lengths) - field_lengths, field_lengths)
+        output[rows, field_offsets[rows] + np.arange(len(ids)) - row_starts] = ids
+    return tf.convert_to_tensor(output)
+
+
 def produce_bspan_decoder_input(previous_bspan, previous_response, user_input):
-    inputs =[]
-    start_symbol = [cfg.vocab_size]
-    for counter, (x, y, z) in enumerate(zip(previous_bspan, previous_response, user_input)):
-        new_sample = start_symbol + x + y + z  # TODO concatenation should be more readable than this
-        inputs.append(new_sample)
-    return tensorize(inputs)
+    return concat_with_start_symbol(previous_bspan, previous_response, user_input)
 
 
 def produce_response_decoder_input(previous_bspan, previous_response, user_input, bspan, kb):
-    start_symbol = [cfg.vocab_size]
-    inputs = []
-    for a, b, c, d, e in zip(previous_bspan, previous_response, user_input, bspan, kb):
-        inputs.append(start_symbol + a + b + c + d + e)
-    return tensorize(inputs)
+    return concat_with_start_symbol(previous_bspan, previous_response, user_input, bspan, kb)
 
 
 class SeqModel:
@@ -469,6 +673,10 @@ class SeqModel:
 
         self.learning_rate = CustomSchedule(d_model, warmup_steps)
         self.optimizer = tf.keras.optimizers.Adam(self.learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+        # float16 gradients underflow without loss scaling
+        self.loss_scaling = tf.keras.mixed_precision.global_policy().compute_dtype == 'float16'
+        if self.loss_scaling:
+            self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.optimizer)
         self.bspan_loss = tf.keras.metrics.Mean(name='train_loss')
         self.response_loss = tf.keras.metrics.Mean(name='train_loss')
         self.bspan_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
@@ -489,54 +697,44 @@ class SeqModel:
                                   pe_target=target_vocab_size,
                                   rate=dropout_rate, copynet=copynet, embeddings_matrix=embeddings_matrix)
 
-    #@tf.function(input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int32),
-    #    tf.TensorSpec(shape=(None, None), dtype=tf.int32)])
-    def train_step_bspan(self, inp, tar):
-        tar_inp = tar[:, :-1]
-        tar_real = tar[:, 1:]
-
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+                                  tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+                                  tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+                                  tf.TensorSpec(shape=(None, None), dtype=tf.int32)], jit_compile=True)
+    def train_step(self, bspan_inp, bspan_tar, response_inp, response_tar):
+        bspan_tar_inp = bspan_tar[:, :-1]
+        bspan_tar_real = bspan_tar[:, 1:]
+        response_tar_inp = response_tar[:, :-1]
+        response_tar_real = response_tar[:, 1:]
 
         with tf.GradientTape() as tape:
-            predictions, _ = self.transformer.bspan(inp=inp, tar=tar_inp, training=True,
-                                                    enc_padding_mask=enc_padding_mask, look_ahead_mask=combined_mask,
-                                                    dec_padding_mask=dec_padding_mask)
+            bspan_predictions, response_predictions = self.transformer.call_both(
+                bspan_inp, bspan_tar_inp, response_inp, response_tar_inp, training=True)
 
-            loss = loss_function(tar_real, predictions)
+            loss = loss_function(bspan_tar_real, bspan_predictions) + \
+                   loss_function(response_tar_real, response_predictions)
+            if self.loss_scaling:
+                loss = self.optimizer.get_scaled_loss(loss)
 
         gradients = tape.gradient(loss, self.transformer.trainable_variables)
+        if self.loss_scaling:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
         gradients =[grad if grad is not None else tf.zeros_like(var)
                     for grad, var in zip(gradients, self.transformer.trainable_variables)]
         self.optimizer.apply_gradients(zip(gradients, self.transformer.trainable_variables))
 
-        self.bspan_accuracy(tar_real, predictions)
-
-    #@tf.function(input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int32),
-    #     tf.TensorSpec(shape=(None, None), dtype=tf.int32)])
-    def train_step_response(self, inp, tar):
-        tar_inp = tar[:, :-1]
-        tar_real = tar[:, 1:]
-
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
-
-        with tf.GradientTape() as tape:
-            predictions, _ = self.transformer.response(inp=inp, tar=tar_inp, training=True,
-                                                       enc_padding_mask=enc_padding_mask, look_ahead_mask=combined_mask,
-                                                       dec_padding_mask=dec_padding_mask)
-            loss = loss_function(tar_real, predictions)
-
-        gradients = tape.gradient(loss, self.transformer.trainable_variables)
-        gradients =[grad if grad is not None else tf.zeros_like(var)
-                    for grad, var in zip(gradients, self.transformer.trainable_variables)]
-        self.optimizer.apply_gradients(zip(gradients, self.transformer.trainable_variables))
-
-        self.response_accuracy(tar_real, predictions)
+        self.bspan_accuracy(bspan_tar_real, bspan_predictions)
+        self.response_accuracy(response_tar_real, response_predictions)
 
     def train_model(self, epochs=20, log=False, max_sent=1, max_turns=1):
         constraint_eos, request_eos, response_eos = "EOS_Z1", "EOS_Z2", "EOS_M"
         for epoch in range(epochs):
             data_iterator = self.reader.mini_batch_iterator('train')
             for iter_num, dial_batch in enumerate(data_iterator):
+                # with teacher forcing the inputs of a turn only depend on the targets of the previous turn,
+                # so all the turns of the dialogues are stacked along the batch dimension and trained at once
+                turns = {'previous_bspan': [], 'previous_response': [], 'user': [], 'bspan': [], 'response': [],
+                         'degree': []}
                 previous_bspan, previous_response = None, None
                 for turn_num, turn_batch in enumerate(dial_batch):
                     _, _, user, response, bspan_received, u_len, m_len, degree, _ = turn_batch.values()
@@ -545,60 +743,97 @@ class SeqModel:
                         previous_bspan = [[self.reader.vocab.encode(constraint_eos),
                                            self.reader.vocab.encode(request_eos)] for i in range(batch_size)]
                         previous_response = [[self.reader.vocab.encode(response_eos)] for i in range(batch_size)]
-                    target_bspan = tensorize([[cfg.vocab_size] + x for x in bspan_received])
-                    target_response = tensorize([[cfg.vocab_size] + x for x in response])
-
-                    bspan_decoder_input = produce_bspan_decoder_input(previous_bspan, previous_response, user)
-                    response_decoder_input = produce_response_decoder_input(previous_bspan, previous_response,
-                                                                            user, bspan_received, degree)
-                    # TODO actually save the models, keeping track of the best one
-
-                    # training the model
-                    self.train_step_bspan(bspan_decoder_input, target_bspan)
-                    self.train_step_response(response_decoder_input, target_response)
+                    turns['previous_bspan'] += previous_bspan
+                    turns['previous_response'] += previous_response
+                    turns['user'] += user
+                    turns['bspan'] += bspan_received
+                    turns['response'] += response
+                    turns['degree'] += degree
 
                     previous_bspan = bspan_received
                     previous_response = response
+
+                target_bspan = tensorize([[cfg.vocab_size] + x for x in turns['bspan']])
+                target_response = tensorize([[cfg.vocab_size] + x for x in turns['response']])
+
+                bspan_decoder_input = produce_bspan_decoder_input(turns['previous_bspan'], turns['previous_response'],
+                                                                  turns['user'])
+                response_decoder_input = produce_response_decoder_input(turns['previous_bspan'],
+                                                                        turns['previous_response'], turns['user'],
+                                                                        turns['bspan'], turns['degree'])
+                # TODO actually save the models, keeping track of the best one
+
+                # training the model
+                self.train_step(bspan_decoder_input, target_bspan, response_decoder_input, target_response)
             print("Completed epoch #{} of {}".format(epoch + 1, epochs))
             # if epoch >= 50 and epoch % 1 == 0:
                 # self.evaluation(verbose=True, log=log, max_sent=max_sent, max_turns=max_turns, use_metric=True, epoch=epoch)
 
+    @tf.function(jit_compile=True, reduce_retracing=True)
+    def _generate(self, input_sequence, decoder, max_length, end_token_id):
+        """Greedily decode up to max_length tokens in a single tf.while_loop.
+        The input is encoded once, every step feeds only the last token to the decoder
+        and reuses the keys and values of the previous positions from the caches.
+        The loop stops once every sequence produced end_token_id, the check stays on the device.
+
+        Returns:
+          output of shape (batch_size, max_length + 1), starting with the start symbol
+          and zero-padded after early stopping
+        """
+        transformer_decoder = self.transformer.bspan_decoder if decoder == "bspan" else self.transformer.response_decoder
+        batch_size = tf.shape(input_sequence)[0]
+
+        enc_padding_mask = create_padding_mask(input_sequence)
+        enc_output, _ = self.transformer.encoder(input_sequence, False, enc_padding_mask)
+        memory = transformer_decoder.project_memory(enc_output)
+        cache = transformer_decoder.initial_cache(batch_size, max_length + 1)
+
+        output = tf.concat([tf.fill([batch_size, 1], cfg.vocab_size),
+                            tf.zeros([batch_size, max_length], dtype=tf.int32)], axis=1)
+        positions = tf.range(max_length + 1)[tf.newaxis, :]
+
+        finished = tf.zeros([batch_size], dtype=tf.bool)
+
+        def cond(i, output, finished, cache):
+            return tf.logical_and(i < max_length, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(i, output, finished, cache):
+            # positions that are not decoded yet are still zero, i.e. padding,
+            # so the padding mask of the output also acts as the look-ahead mask
+            look_ahead_mask = create_padding_mask(output)
+            predictions, cache = self.transformer.decode_step(transformer_decoder, input_sequence,
+                                                              tf.slice(output, [0, i], [-1, 1]), i,
+                                                              enc_output, memory, cache,
+                                                              look_ahead_mask, enc_padding_mask)
+            predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)  # (batch_size, 1)
+            output = tf.where(tf.equal(positions, i + 1), predicted_id, output)
+            finished = tf.logical_or(finished, tf.equal(predicted_id[:, 0], end_token_id))
+            return i + 1, output, finished, cache
+
+        _, output, _, _ = tf.while_loop(cond, body, (0, output, finished, cache))
+        return output
+
     def auto_regress(self, input_sequence, decoder, MAX_LENGTH=128):
         assert decoder in ["bspan", "response"]
-        decoder_input = [cfg.vocab_size]
-        output = tf.expand_dims(decoder_input, 0)
 
         end_token_id = self.reader.vocab.encode("EOS_Z2") if decoder == "bspan" else self.reader.vocab.encode("EOS_M")
 
-        for i in range(MAX_LENGTH):
-            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(input_sequence, output)
-
-            if decoder == "bspan":
-                predictions, attention_weights = self.transformer.bspan(input_sequence, output, False,
-                                                                        enc_padding_mask, combined_mask,
-                                                                        dec_padding_mask)
-            else:
-                predictions, attention_weights = self.transformer.response(input_sequence, output, False,
-                                                                           enc_padding_mask, combined_mask,
-                                                                           dec_padding_mask)
-
-            predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
-            predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
-
-            output = tf.concat([output, predicted_id], axis=-1)
+        output = tf.squeeze(self._generate(input_sequence, decoder, MAX_LENGTH, end_token_id), axis=0)
 
-            if predicted_id == end_token_id:
-                return tf.squeeze(output, axis=0), attention_weights
+        # cut the output after the first end token (the only transfer of the decoded sequence to the host)
+        end_positions = tf.where(tf.equal(output[1:], end_token_id))
+        if tf.size(end_positions) > 0:
+            output = output[:int(end_positions[0, 0]) + 2]
 
-        return tf.squeeze(output, axis=0), attention_weights
+        return output
 
     def evaluate(self, previous_bspan, previous_response, user, degree):
         bspan_decoder_input = produce_bspan_decoder_input([previous_bspan], [previous_response], [user])
-        predicted_bspan, _ = self.auto_regress(bspan_decoder_input, "bspan")
+        predicted_bspan = self.auto_regress(bspan_decoder_input, "bspan")
 
         response_decoder_input = produce_response_decoder_input([previous_bspan], [previous_response],
                                                                 [user], [list(predicted_bspan.numpy())], [degree])
-        predicted_response, _ = self.auto_regress(response_decoder_input, "response")
+        predicted_response = self.auto_regress(response_decoder_input, "response")
         return predicted_response
 
     def evaluation(self, mode="dev", verbose=False, log=False, max_sent=1, max_turns=1, use_metric=False, epoch=999):
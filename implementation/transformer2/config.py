@@ -2,10 +2,107 @@ import logging
 import os
 import time
 import configparser
+import threading
 
 class _Config:
-    def __init__(self):
-        self._init_logging_handler()
+    """Global configuration, a singleton shared by every `_Config()` (see `global_config`).
+
+    Importing the module has no side effects, logging is set up by the first `init_handler` call.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    # settings of every `init_handler` mode, applied on top of the defaults
+    _presets = {
+        'tsdf-camrest': {
+            'beam_len_bonus': 0.5,
+            'prev_z_method': 'concat',  # important for transformer (should be 'concat')
+            'vocab_size': 800,
+            'embedding_size': 50,
+            'hidden_size': 50,
+            'split': (3, 1, 1),
+            'lr': 0.003,
+            'lr_decay': 0.5,
+            'vocab_path': './vocab/vocab-camrest.pkl',
+            'data': './data/CamRest676/CamRest676.json',
+            'entity': './data/CamRest676/CamRestOTGY.json',
+            'db': './data/CamRest676/CamRestDB.json',
+            'glove_path': './data/glove/glove.6B.50d.txt',
+            'batch_size': 16,
+            'z_length': 8,
+            'degree_size': 5,
+            'layer_num': 1,
+            'dropout_rate': 0.5,
+            'epoch_num': 20,  # triggered by early stop
+            'rl_epoch_num': 1,
+            'cuda': False,
+            'spv_proportion': 100,
+            'max_ts': 106,
+            'early_stop_count': 3,
+            'new_vocab': True,
+            'model_path': './models/camrest.pkl',
+            'result_path': './results/camrest-rl.csv',
+            'teacher_force': 100,
+            'beam_search': False,
+            'beam_size': 10,
+            'sampling': False,
+            'use_positional_embedding': False,
+            'unfrz_attn_epoch': 0,
+            'skip_unsup': False,
+            'truncated': False,
+            'pretrain': False,
+        },
+        'tsdf-kvret': {
+            'prev_z_method': 'concat',
+            'intent': 'all',
+            'vocab_size': 1400,
+            'embedding_size': 50,
+            'hidden_size': 50,
+            'split': None,
+            'lr': 0.003,
+            'lr_decay': 0.5,
+            'vocab_path': './vocab/vocab-kvret.pkl',
+            'train': './data/kvret/kvret_train_public.json',
+            'dev': './data/kvret/kvret_dev_public.json',
+            'test': './data/kvret/kvret_test_public.json',
+            'entity': './data/kvret/kvret_entities.json',
+            'glove_path': './data/glove/glove.6B.50d.txt',
+            'batch_size': 32,
+            'degree_size': 5,
+            'z_length': 8,
+            'layer_num': 1,
+            'dropout_rate': 0.5,
+            'epoch_num': 2,
+            'rl_epoch_num': 2,
+            'cuda': False,
+            'spv_proportion': 100,
+            'alpha': 0.0,
+            'max_ts': 106,
+            'early_stop_count': 3,
+            'new_vocab': True,
+            'model_path': './models/kvret.pkl',
+            'result_path': './results/kvret.csv',
+            'teacher_force': 100,
+            'beam_search': False,
+            'beam_size': 10,
+            'sampling': False,
+            'use_positional_embedding': False,
+            'unfrz_attn_epoch': 0,
+            'skip_unsup': False,
+            'truncated': False,
+            'pretrain': False,
+        },
+    }
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance._init_defaults()
+        return cls._instance
+
+    def _init_defaults(self):
+        self._logging_ready = False
         self.cuda_device = 0        
         self.eos_m_token = 'EOS_M'       
         self.beam_len_bonus = 0.6
@@ -18,95 +115,18 @@ class _Config:
         self.seed = 0
   
     def init_handler(self, m):
-        init_method = {
-            'tsdf-camrest':self._camrest_tsdf_init,
-            'tsdf-kvret':self._kvret_tsdf_init
-        }
-        init_method[m]()
-
-    def _camrest_tsdf_init(self):
-        self.beam_len_bonus = 0.5
-        self.prev_z_method = 'concat'  # important for transformer (should be 'concat')
-        self.vocab_size = 800
-        self.embedding_size = 50
-        self.hidden_size = 50
-        self.split = (3, 1, 1)
-        self.lr = 0.003
-        self.lr_decay = 0.5
-        self.vocab_path = './vocab/vocab-camrest.pkl'
-        self.data = './data/CamRest676/CamRest676.json'
-        self.entity = './data/CamRest676/CamRestOTGY.json'
-        self.db = './data/CamRest676/CamRestDB.json'
-        self.glove_path = './data/glove/glove.6B.50d.txt'
-        self.batch_size = 16 
-        self.z_length = 8
-        self.degree_size = 5
-        self.layer_num = 1
-        self.dropout_rate = 0.5
-        self.epoch_num = 20 # triggered by early stop
-        self.rl_epoch_num = 1
-        self.cuda = False
-        self.spv_proportion = 100
-        self.max_ts = 106
-        self.early_stop_count = 3
-        self.new_vocab = True
-        self.model_path = './models/camrest.pkl'
-        self.result_path = './results/camrest-rl.csv'
-        self.teacher_force = 100
-        self.beam_search = False
-        self.beam_size = 10
-        self.sampling = False
-        self.use_positional_embedding = False
-        self.unfrz_attn_epoch = 0
-        self.skip_unsup = False
-        self.truncated = False
-        self.pretrain = False
+        if not self._logging_ready:
+            self._init_logging_handler()
+            self._logging_ready = True
+        self._apply(self._presets[m])
 
-    def _kvret_tsdf_init(self):
-        self.prev_z_method = 'concat'
-        self.intent = 'all'
-        self.vocab_size = 1400
-        self.embedding_size = 50
-        self.hidden_size = 50
-        self.split = None
-        self.lr = 0.003
-        self.lr_decay = 0.5
-        self.vocab_path = './vocab/vocab-kvret.pkl'
-        self.train = './data/kvret/kvret_train_public.json'
-        self.dev = './data/kvret/kvret_dev_public.json'
-        self.test = './data/kvret/kvret_test_public.json'
-        self.entity = './data/kvret/kvret_entities.json'
-        self.glove_path = './data/glove/glove.6B.50d.txt'
-        self.batch_size = 32
-        self.degree_size = 5
-        self.z_length = 8
-        self.layer_num = 1
-        self.dropout_rate = 0.5
-        self.epoch_num = 2
-        self.rl_epoch_num = 2
-        self.cuda = False
-        self.spv_proportion = 100
-        self.alpha = 0.0
-        self.max_ts = 106
-        self.early_stop_count = 3
-        self.new_vocab = True
-        self.model_path = './models/kvret.pkl'
-        self.result_path = './results/kvret.csv'
-        self.teacher_force = 100
-        self.beam_search = False
-        self.beam_size = 10
-        self.sampling = False
-        self.use_positional_embedding = False
-        self.unfrz_attn_epoch = 0
-        self.skip_unsup = False
-        self.truncated = False
-        self.pretrain = False
+    def _apply(self, settings):
+        for k, v in settings.items():
+            setattr(self, k, v)
 
     def __str__(self):
-        s = ''
-        for k,v in self.__dict__.items():
-            s += '{} : {}\n'.format(k,v)
-        return s
+        # settings only, not the private state such as `_logging_ready`
+        return ''.join('{} : {}\n'.format(k, v) for k, v in self.__dict__.items() if not k.startswith('_'))
 
     def _init_logging_handler(self):
         if not os.path.exists("log"):
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import itertools
 import math
 import os
 import argparse
@@ -7,6 +8,7 @@ import argparse
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn import TransformerEncoder, TransformerEncoderLayer, TransformerDecoder, TransformerDecoderLayer
 import numpy as np
 
 from config import global_config as cfg
@@ -16,7 +18,7 @@ import reader
 # TODO:
 # 1. (maybe) do encoding for user and machine separately (additional positional encoding)
 # 2. does torch transformer do teacher forcing? should it?
-# 3. (solved) (HIGH PRIORITY) how to pass bspan to ResponseDecoder. Put it as an input and dont mask it. Make constant size for bspan (~ 20-30 words) and add some padding (new one?)
+# 3. (solved) (HIGH PRIORITY) how to pass bspan to the response decoder. Put it as an input and dont mask it. Make constant size for bspan (~ 20-30 words) and add some padding (new one?)
 # 4. (A BIG TODO) probably a stupid question (ondra), but where is specified the size of input to transformer??? (either encoder, or decoder)
 #       is it the `d_model` (=`ninp`) variable????
 # 5. Sort out dimensions of inputs to en/decoders. This certainly is not working right now!! 
@@ -32,18 +34,104 @@ class PositionalEncoding(nn.Module):
         super().__init__()
         self.dropout = nn.Dropout(p=dropout)
 
-        pe = torch.zeros(max_len, d_model)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
+        angles = position * div_term  # (max_len, d_model / 2)
+        # interleave sin and cos (sin on the even, cos on the odd dimensions), directly in the
+        # (1, max_len, d_model) layout of the (batch, seq_len, d_model) inputs
+        pe = torch.stack([angles.sin(), angles.cos()], dim=-1).flatten(-2).unsqueeze(0)
         self.register_buffer('pe', pe)
 
     def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
+        if torch.is_grad_enabled():
+            x = x + self.pe[:, :x.size(1)]
+        else:
+            # nothing to backpropagate (inference), add to the embeddings in place
+            x.add_(self.pe[:, :x.size(1)])
         return self.dropout(x)
 
+def attention_mask(size, unmasked=0):
+    """ Boolean (size, size) attention mask of a decoder, True where attention is not allowed
+    (the same convention as the padding masks).
+
+    Position i attends to the positions up to max(i, `unmasked`), i.e. the mask is causal for
+    `unmasked` = 0 and otherwise leaves the positions up to `unmasked` visible to all positions
+    (and to each other), while the later positions stay causal.
+    """
+    position = torch.arange(size)
+    return position[None, :] > torch.clamp(position[:, None], min=unmasked)
+
+def _split_heads(x, num_heads):
+    """ (batch, seq_len, d_model) -> (batch, num_heads, seq_len, d_model / num_heads) """
+    return x.view(x.size(0), x.size(1), num_heads, -1).transpose(1, 2)
+
+def _attend(attn, q, k, v, key_padding_mask=None):
+    """ Scaled dot product attention of the projected heads, followed by the output projection
+    of `attn` (a `nn.MultiheadAttention`, used for its weights only, without dropout) """
+    scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(q.size(-1))
+    if key_padding_mask is not None:
+        scores = scores.masked_fill(key_padding_mask[:, None, None, :], float('-inf'))
+    output = torch.matmul(scores.softmax(dim=-1), v).transpose(1, 2).flatten(2)
+    return F.linear(output, attn.out_proj.weight, attn.out_proj.bias)
+
+def init_decoder_cache(decoder, memory):
+    """ Cache for `cached_decoder_step`, one dict per layer of `decoder` (a `TransformerDecoder`).
+    The keys and values of the encoder output are computed here, once for the whole decoding. """
+    cache = []
+    for layer in decoder.layers:
+        attn = layer.multihead_attn
+        _, w_k, w_v = attn.in_proj_weight.chunk(3)
+        _, b_k, b_v = attn.in_proj_bias.chunk(3)
+        cache.append({'memory': (_split_heads(F.linear(memory, w_k, b_k), attn.num_heads),
+                                 _split_heads(F.linear(memory, w_v, b_v), attn.num_heads))})
+    return cache
+
+def cached_decoder_step(decoder, x, cache, padding_mask, memory_mask=None):
+    """ Run the (post-norm, eval mode) `TransformerDecoder` on the new positions only.
+
+    The keys and values of the previous positions are taken from `cache` (see
+    `init_decoder_cache`), the ones of the new positions are appended to it. The new
+    positions attend to all the previous ones and to each other, so only the last
+    position may be new unless the new positions are a fully visible prefix.
+
+    Args:
+        decoder: `TransformerDecoder`
+        x: embedded new positions, shape: (batch, new_len, d_model)
+        cache: per layer keys and values, updated in place
+        padding_mask: padding mask of all the positions so far (including the new ones), shape: (batch, seq_len)
+        memory_mask: padding mask of the encoder input, shape: (batch, src_seq)
+
+    Returns:
+        decoder output of the new positions, shape: (batch, new_len, d_model)
+    """
+    for layer, layer_cache in zip(decoder.layers, cache):
+        attn = layer.self_attn
+        q, k, v = (_split_heads(y, attn.num_heads)
+                   for y in F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1))
+        if 'self' in layer_cache:
+            k = torch.cat([layer_cache['self'][0], k], dim=2)
+            v = torch.cat([layer_cache['self'][1], v], dim=2)
+        layer_cache['self'] = (k, v)
+        x = layer.norm1(x + _attend(attn, q, k, v, padding_mask))
+
+        attn = layer.multihead_attn
+        w_q, _, _ = attn.in_proj_weight.chunk(3)
+        b_q, _, _ = attn.in_proj_bias.chunk(3)
+        q = _split_heads(F.linear(x, w_q, b_q), attn.num_heads)
+        x = layer.norm2(x + _attend(attn, q, *layer_cache['memory'], memory_mask))
+
+        x = layer.norm3(x + layer.linear2(layer.activation(layer.linear1(x))))
+    if decoder.norm is not None:
+        x = decoder.norm(x)
+    return x
+
+def scaled_embedding(ntoken, ninp):
+    """ New embedding with the weights pre-scaled by sqrt(ninp), like the ones set by `init_embedding` """
+    embedding = nn.Embedding(ntoken, ninp)
+    with torch.no_grad():
+        embedding.weight.mul_(math.sqrt(ninp))
+    return embedding
+
 class Encoder(nn.Module):
     """ User utterance encoder
 
@@ -54,16 +142,18 @@ class Encoder(nn.Module):
         nhid: hidden layer size
         nlayers: number of layers
         dropout: dropout rate
+        embedding: shared embedding (pre-scaled, see `init_embedding`), a new one is created if None
+        pos_encoder: shared `PositionalEncoding`, a new one is created if None
     """
-    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, params, dropout=0.5, embedding=None):
+    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, params, dropout=0.5, embedding=None, pos_encoder=None):
         super().__init__()
-        from torch.nn import TransformerEncoder, TransformerEncoderLayer
         self.model_type = 'TransformerEncoder'
         self.src_mask = None
-        self.pos_encoder = PositionalEncoding(ninp, dropout)
-        encoder_layers = TransformerEncoderLayer(ninp, nhead, nhid, dropout)
+        self.pos_encoder = PositionalEncoding(ninp, dropout) if pos_encoder is None else pos_encoder
+        # batch first layers take the (batch, seq_len) inputs as they are, without transposes
+        encoder_layers = TransformerEncoderLayer(ninp, nhead, nhid, dropout, batch_first=True)
         self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
-        self.embedding = nn.Embedding(ntoken, ninp) if embedding is None else embedding
+        self.embedding = scaled_embedding(ntoken, ninp) if embedding is None else embedding
         self.ninp = ninp
         self.params = params
 
@@ -73,19 +163,22 @@ class Encoder(nn.Module):
         # initrange = 0.1
         # self.embedding.weight.data.uniform_(-initrange, initrange)
 
-    def train(self, t=True):
-        self.transformer_encoder.train(t)
-
     def forward(self, src):
-        mask = src.eq(0).transpose(0,1)  # 0 corresponds to <pad>
-        src = self.embedding(src) * self.ninp
+        mask = src.eq(0)  # 0 corresponds to <pad>
+        src = self.embedding(src)  # the embedding weights are pre-scaled, see `init_embedding`
         src = self.pos_encoder(src)
         output = self.transformer_encoder(src, src_key_padding_mask=mask)
         return output
 
-class BSpanDecoder(nn.Module):
-    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, reader_, params, dropout=0.5, embedding=None):
-        """
+class Decoder(nn.Module):
+    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, reader_, params, dropout=0.5, embedding=None,
+                 pos_encoder=None, go_id=1, unmasked=0):
+        """ Decoder of either the bspan or the response
+
+        The bspan decoder decodes after a GO_2 token (`go_id` = 3) with a causal mask. The response
+        decoder is given the degree and the bspan in front of its GO token (`go_id` = 1), which are
+        visible to all the positions (`unmasked` = bspan_size + 1, see `attention_mask`).
+
         Args:
             ntoken: vocab size
             ninp: embedding dimension
@@ -94,167 +187,103 @@ class BSpanDecoder(nn.Module):
             nlayers: number of layers
             reader: instance of `Reader`
             dropout: dropout rate
+            embedding: shared embedding (pre-scaled, see `init_embedding`), a new one is created if None
+            pos_encoder: shared `PositionalEncoding`, a new one is created if None
+            go_id: index of the GO token the decoding starts with
+            unmasked: last position of the prefix visible to all the positions
         """
         super().__init__()
-        from torch.nn import TransformerDecoder, TransformerDecoderLayer
         self.model_type = 'TransformerDecoder'
         self.src_mask = None
-        self.pos_encoder = PositionalEncoding(ninp, dropout)
-        decoder_layers = TransformerDecoderLayer(ninp, nhead, nhid, dropout)
+        self.pos_encoder = PositionalEncoding(ninp, dropout) if pos_encoder is None else pos_encoder
+        decoder_layers = TransformerDecoderLayer(ninp, nhead, nhid, dropout, batch_first=True)
         self.transformer_decoder = TransformerDecoder(decoder_layers, nlayers)
-        self.embedding = nn.Embedding(ntoken, ninp) if embedding is None else embedding
+        self.embedding = scaled_embedding(ntoken, ninp) if embedding is None else embedding
         self.ninp = ninp
-        self.linear = nn.Linear(ninp, ntoken)
+        # the output projection is tied to the embedding, only its bias is separate
+        self.out_bias = nn.Parameter(torch.zeros(ntoken))
         self.reader_ = reader_
         self.params = params
+        self.go_id = go_id
+
+        # the mask for the longest sequence the positional encoding supports (+1 for the degree),
+        # built once and sliced for shorter ones
+        self.register_buffer('_causal', attention_mask(self.pos_encoder.pe.size(1) + 1, unmasked), persistent=False)
 
         self.init_weights()
 
     def init_weights(self):
         initrange = 0.1
         # self.embedding.weight.data.uniform_(-initrange, initrange)
-        self.linear.bias.data.zero_()
-        self.linear.weight.data.uniform_(-initrange, initrange)
-
-    def train(self, t=True):
-        self.transformer_decoder.train(t)
+        self.out_bias.data.zero_()
 
     def _generate_square_subsequent_mask(self, sz):
         """ This makes the model autoregressive.
-        When decoding position t, look only at positions 0...t-1 """
-        mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
+        When decoding position t, look only at positions 0...t-1 (and the unmasked ones) """
+        return self._causal[:sz, :sz]
 
-    def forward(self, tgt, memory):
-        """ Call decoder
-        the decoder should be called repeatedly
-
-        Args:
-            tgt: input to transformer_decoder, shape: (seq, batch)
-            memory: output from the encoder
+    def _embed(self, tgt, bspan=None, degree=None):
+        """ Embed [bspan, GO, tgt], prepended by the degree (which has no positional encoding)
 
         Returns:
-            output from linear layer, (vocab size), pre softmax
-
+            embedded sequence (batch, seq_len, ninp) and its padding mask (batch, seq_len)
         """
-        tgt = tgt.long()
-        go_tokens = torch.zeros((1, tgt.size(1)), dtype=tgt.dtype) + 3  # GO_2 token has index 3
-
-        tgt = torch.cat([go_tokens, tgt], dim=0)  # concat GO_2 token along sequence lenght axis
-
-
-        mask = tgt.eq(0).transpose(0,1)  # 0 corresponds to <pad>
-        tgt = self.embedding(tgt) * self.ninp
+        go_tokens = torch.full((tgt.size(0), 1), self.go_id, dtype=torch.long, device=tgt.device)
+        ids = [go_tokens, tgt.long()]
+        if bspan is not None:
+            ids.insert(0, bspan.long())
+        ids = torch.cat(ids, dim=1)  # concat along sequence length axis
+
+        mask = ids.eq(0)  # 0 corresponds to <pad>
+        tgt = self.embedding(ids)  # the embedding weights are pre-scaled, see `init_embedding`
         tgt = self.pos_encoder(tgt)
-        tgt_mask = self._generate_square_subsequent_mask(tgt.size(0))
-        output = self.transformer_decoder(tgt, memory, tgt_mask=tgt_mask, tgt_key_padding_mask=mask)
-        output = self.linear(output)
-        return output
 
-class ResponseDecoder(nn.Module):
-    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, reader_, params, dropout=0.5, embedding=None):
-        """
-        Args:
-            ntoken: vocab size
-            ninp: embedding dimension
-            nhead: number of heads
-            nhid: hidden layer size
-            nlayers: number of layers
-            reader: instance of `Reader`
-            dropout: dropout rate
-        """
-        super().__init__()
-        from torch.nn import TransformerDecoder, TransformerDecoderLayer
-        self.model_type = 'TransformerDecoder'
-        self.src_mask = None
-        self.pos_encoder = PositionalEncoding(ninp, dropout)
-        decoder_layers = TransformerDecoderLayer(ninp, nhead, nhid, dropout)
-        self.transformer_decoder = TransformerDecoder(decoder_layers, nlayers)
-        self.embedding = nn.Embedding(ntoken, ninp) if embedding is None else embedding
-        self.ninp = ninp
-        self.linear = nn.Linear(ninp, ntoken)
-        self.reader_ = reader_
-        self.params = params
+        #    eg. [01000 cheap restaurant EOS_Z1 EOS_Z2 PAD2 .... PAD2 GO1 mask mask mask ..... ]
+        #    ... [degree           ...          bspan    ... padding  go     ....     masking ]
+        if degree is not None:
+            degree_reshaped = tgt.new_zeros((tgt.size(0), 1, tgt.size(2)))
+            degree_reshaped[:, 0, :cfg.degree_size] = degree  # add 1 more timestep (the first one as one-hot degree)
+            tgt = torch.cat([degree_reshaped, tgt], dim=1)
+            mask = torch.cat([mask.new_zeros((mask.size(0), 1)), mask], dim=1)  # the degree is never masked
+        return tgt, mask
+
+    def _project(self, output):
+        """ Output projection to the vocabulary, pre softmax """
+        with torch.autocast(device_type=output.device.type, enabled=False):
+            # logits in float32, the embedding weights are pre-scaled by sqrt(ninp) (see `init_embedding`),
+            # undo that on the (smaller) decoder output rather than on the logits
+            return F.linear(output.float() / math.sqrt(self.ninp), self.embedding.weight, self.out_bias)
+
+    def decoding_prefix(self, batch_size, bspan=None, degree=None):
+        """ Start of greedy decoding (see `SequicityModel._greedy_decode_output`)
 
-        self.init_weights()
-
-    def init_weights(self):
-        initrange = 0.1
-        # self.embedding.weight.data.uniform_(-initrange, initrange)
-        self.linear.bias.data.zero_()
-        self.linear.weight.data.uniform_(-initrange, initrange)
-
-    def train(self, t=True):
-        self.transformer_decoder.train(t)
-
-    def _generate_square_subsequent_mask(self, sz, bspan_size):
-        # we do not mask the first positions (1 for degree, 1 for <go> token and 'some' for bspan)
-        bspan_size = self.params['bspan_size']
-        mask = (torch.triu(torch.ones(sz+1, sz+1), diagonal=-(bspan_size+1)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
+        Returns:
+            embedded prefix (degree, bspan and GO token), its padding mask and the position
+            of the first decoded token
+        """
+        tgt = torch.zeros((batch_size, 0), dtype=torch.long, device=self.out_bias.device)
+        prefix, mask = self._embed(tgt, bspan, degree)
+        return prefix, mask, 1 if bspan is None else bspan.size(1) + 1
 
-    def forward(self, tgt, memory, bspan, degree):
+    def forward(self, tgt, memory, bspan=None, degree=None, memory_mask=None):
         """ Call decoder
 
         Args:
-            tgt: input to transformer_decoder, shape: (seq_len, batch)
+            tgt: input to transformer_decoder, shape: (batch, seq_len)
             memory: output from the encoder
+            bspan: bspan in front of the response, shape: (batch, bspan_size)
             degree: degree is the 'output from database', shape: (batch, cfg.degree_size)
+            memory_mask: padding mask of the encoder input, shape: (batch, src_seq)
 
         Returns:
-            output from linear layer, (vocab size), pre softmax
+            output from the output projection, (vocab size), pre softmax
 
         """
-
-        go_tokens = torch.ones((1, tgt.size(1)), dtype=tgt.dtype)  # GO token has index 1
-        degree_reshaped = torch.zeros((1, tgt.size(1), cfg.embedding_size), dtype=torch.float32)
-        # print('tgt.shape0')
-        # print(tgt.shape)
-        # print('bspan.shape0')
-        # print(bspan.shape)
-        # print('degree_ershaped.shape0')
-        # print(degree_reshaped.shape)
-        # print('go_tokens.shape0')
-        # print(go_tokens.shape)
-
-        tgt = torch.cat([bspan, go_tokens, tgt], dim=0)  # concat bspan, GO and tokenstoken along sequence length axis
-        # TODO pad `tgt` but also think of `degree` which is added later
-        # print('tgt.shape')
-        # print(tgt.shape)
-
-
-        mask = torch.cat([torch.ones((1, tgt.size(1)), dtype=torch.int64), tgt]).eq(0).transpose(0,1)  # 0 corresponds to <pad>
-        # TODO dimension are wrong
-        # TODO also, final tgt dimension should be cfg.max_ts (128). however, now it is 128 before bspan is concatednated with it
-        # mask = torch.cat([torch.ones((mask.size(0), 1)).bool(), mask])
-        tgt = self.embedding(tgt) * self.ninp
-        tgt = self.pos_encoder(tgt)
-        # print('tgt.shape2')
-        # print(tgt.shape)
-
-        #    eg. [cheap restaurant EOS_Z1 EOS_Z2 PAD2 .... PAD2 01000 GO1 mask mask mask ..... ]
-        #    ... [            ...          bspan    ... padding degree go     ....     masking ]
-
-
-        # A BIG TODO: the size of `tgt` has to take the size of `bspan` (+1+1 for degree, go)  into account
-        bspan_size = self.params['bspan_size']  # always the same
-        tgt_mask = self._generate_square_subsequent_mask(tgt.size(0), bspan_size)
-
-        # tgt.size(1) is batch size (I know, why dim=1, but nn.Transformer wants it that way)
-        degree_reshaped[0, :, :cfg.degree_size] = degree.transpose(0,1)  # add 1 more timestep (the first one as one-hot degree)
-        tgt = torch.cat([degree_reshaped, tgt], dim=0)  # concat along sequence lenght axis
-        # print('tgt.shape3')
-        # print(tgt.shape)
-
-        # THE ERROR: src_len is 150 and key_padding_mask.size(1) is 149
-        # BOTH are wrong and should be 128 (currently max_len)
-        output = self.transformer_decoder(tgt, memory, tgt_mask=tgt_mask, tgt_key_padding_mask=mask)
-        output = self.linear(output)
-        # print('output.shape')
-        # print(output.shape)
-        return output
+        tgt, mask = self._embed(tgt, bspan, degree)
+        tgt_mask = self._generate_square_subsequent_mask(tgt.size(1))
+        output = self.transformer_decoder(tgt, memory, tgt_mask=tgt_mask, tgt_key_padding_mask=mask,
+                                          memory_key_padding_mask=memory_mask)
+        return self._project(output)
 
 
 class SequicityModel(nn.Module):
@@ -269,73 +298,48 @@ class SequicityModel(nn.Module):
         self.reader_ = reader_
         self.params = params
 
-    def train(self, t=True):
-        super().train(t)
-        self.encoder.train(t)
-        self.bspan_decoder.train(t)
-        self.response_decoder.train(t)
+    def _greedy_decode_output(self, decoder, encoder_output, eos_id, max_ts, bspan=None, degree=None, memory_mask=None):
+        """ Autoregressive decoder: decode one step at a time, feeding only the new word
 
-    def _greedy_decode_output(self, decoder, encoder_output, initial_decoder_input, eos_id, max_ts, response=False, bspan=None, degree=None):
-        """ Autoregressive decoder: decode one step at a time, and run again with new word
+        The keys and values of the already decoded positions are cached (see `cached_decoder_step`),
+        so every step runs the decoder on a single position.
 
         Args:
-            decoder: instance of either bspan or response decoder
+            decoder: `Decoder` of either bspan or response
             encoder_output: output from encoder
-            initial_decoder_input: target
             eos_id: id of either EOS_M, EOS_Z1, EOS_Z2
             max_ts: max timestep, different for BspanDec and ResponDec
-            bspan: use only for ResponseDecoder
-            degree: use only for ResponseDecoder
+            bspan: use only for the response decoder
+            degree: use only for the response decoder
+            memory_mask: padding mask of the encoder input
 
         Returns:
-            a tensor, shape (seq_len, batch) with decoded output
+            a tensor, shape (batch, max_ts) with decoded output, padded after `eos_id`
 
         """
-        input_ = initial_decoder_input  # shape (seq_len, batch)?
-        print('inp_', input_.shape)
-        pad_id = 0 if response else 4  # 4 is index for <pad2>
-        if response:
-            decoded_sentences = torch.zeros((128, input_.size(1)), dtype=torch.int64) * pad_id
-        else:
-            decoded_sentences = torch.zeros_like(input_, dtype=torch.int64) * pad_id
-
-        print('decoded_sent', decoded_sentences.shape)
-        mask = torch.ones(input_.size(1)).bool()  # shape: batch
-        if response:
-            low = 128-max_ts
-            high = 128
-        else:
-            low = 0
-            high = max_ts
-        for t in range(low, high):
-            if response:  # response decoder
-                out = decoder(input_, encoder_output, bspan, degree)
-                print(out.shape)
-            else:
-                out = decoder(input_, encoder_output)
-
-            # probs = nn.Softmax(out, dim=-1)  # may not be true: shape: (seq_len, batch, probs)
-
-            # probs = nn.functional.softmax(out[t,:,:], dim=-1)  # get prob for only t timestep (1,batch,probs)?
-            _, inds = torch.topk(out[t,:,:], 1, dim=-1)  # greedy decode (1, batch, 1)
-            # print(inds)
-
-            inds.squeeze_(-1)  # (1, batch, 1) -> (1, batch)
-            inds.squeeze_(0)  # (batch)
-
-            # decoded_sentences[t,:].masked_scatter_(mask, inds)  # set decoded word at time step t for the whole batch
-            decoded_sentences[t,:] = inds
-
-            # TODO this does not work, for response, it should decode only sequnce after bspan, degre...
-            if response:
-                input_[t-max_ts, :] = inds
-            else:
-                input_[t, :] = inds
-
-
-            # set mask if EOS is reached
-            # current_t_mask = (inds != eos_id)  # 0 if eos at t timestep
-            # mask = current_t_mask & mask
+        batch_size = encoder_output.size(0)
+        # padded with <pad> (0), like the targets in training (see `_pad_rows`), so that a decoded
+        # bspan is masked after its EOS when it is fed to the response decoder
+        pad_id = 0
+        x, mask, position = decoder.decoding_prefix(batch_size, bspan, degree)
+        cache = init_decoder_cache(decoder.transformer_decoder, encoder_output)
+
+        decoded_sentences = torch.full((batch_size, max_ts), pad_id, dtype=torch.long, device=encoder_output.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=encoder_output.device)
+        for t in range(max_ts):
+            output = cached_decoder_step(decoder.transformer_decoder, x, cache, mask, memory_mask)
+            out = decoder._project(output[:, -1])  # the logits of the last position only
+
+            # greedy decoding only needs the argmax of the logits, no softmax
+            inds = out.argmax(dim=-1).masked_fill_(finished, pad_id)  # (batch)
+            decoded_sentences[:, t] = inds
+            finished |= inds.eq(eos_id)
+            # the check copies to the host, which waits for the device, so do it only every few steps
+            if t % 8 == 7 and finished.all():
+                break
+
+            x = decoder.embedding(inds).unsqueeze(1) + decoder.pos_encoder.pe[:, position + t]
+            mask = torch.cat([mask, inds.eq(0).unsqueeze(1)], dim=1)
 
         return decoded_sentences
 
@@ -354,48 +358,47 @@ class SequicityModel(nn.Module):
         Returns:
 
         """
-        # transpose input to (seq_len, batch)
-        # user_input = user_input.transpose(0,1)
-        # bdecoder_input = bdecoder_input.transpose(0,1)
-        # rdecoder_input = rdecoder_input.transpose(0,1)
+        # all the inputs are (batch, seq_len), as are the outputs of the batch first transformer layers
 
-        response_decoded = None
-        encoded = self.encoder(user_input)
+        # mixed precision on GPUs, bfloat16 for training where supported (otherwise float16 with
+        # a `GradScaler`, see `main_function`) and float16 for inference
+        # (the decoders compute the logits in float32)
+        cuda = user_input.is_cuda
+        dtype = torch.bfloat16 if self.training and cuda and torch.cuda.is_bf16_supported() else torch.float16
+        with torch.autocast(device_type='cuda', dtype=dtype, enabled=cuda):
+            response_decoded = None
+            encoded = self.encoder(user_input)
+            # the encoder output at padded positions carries no information, keep the decoders' attention off them
+            memory_mask = user_input.eq(0)  # 0 corresponds to <pad>
 
-        if self.training:
-            bdecoder_input = bdecoder_input
-        else:
-            bdecoder_input = torch.zeros(self.params['bspan_size'], bdecoder_input.size(1), dtype=torch.long) # go token is added later, in BSpanDecoder (seq_len, batch)
+            # Even during training, we always have to decode BSpan, because we pass it to Response decoder
 
-        # Even during training, we always have to decode BSpan, because we pass it to Response decoder
 
 
-
-        if self.training:
-            # during training we will do only one pass through decoder and train on 
-            # probabilities, outputs of softmax instead of one-hot decoded words.
-            # TODO should we use decoded bspan or the supplied one? if supplied, we have to train BSpanDecoder somehow.
-            response = self.response_decoder(rdecoder_input, encoded, bdecoder_input, degree)
-        else:
-            bspan_decoded = self._greedy_decode_output(\
-                                       self.bspan_decoder, \
-                                       encoded, \
-                                       bdecoder_input, \
-                                       self.reader_.vocab.encode('EOS_Z2'),\
-                                       self.params['bspan_size'])
-            print('bspan dec', bspan_decoded.shape)
-            #response = self.response_decoder(concat, encoded, bspan_decoded, degree)
-            response = None# self.response_decoder(rdecoder_input, encoded, bspan_decoded, degree)
-            response_decoded = self._greedy_decode_output(\
-                                       self.response_decoder, \
-                                       encoded, \
-                                       rdecoder_input, \
-                                       self.reader_.vocab.encode('EOS_M'),\
-                                       cfg.max_ts, \
-                                       True, \
-                                       bspan_decoded, \
-                                       degree)
-            print(response_decoded.shape)
+            if self.training:
+                # during training we will do only one pass through decoder and train on 
+                # probabilities, outputs of softmax instead of one-hot decoded words.
+                # TODO should we use decoded bspan or the supplied one? if supplied, we have to train the bspan decoder somehow.
+                response = self.response_decoder(rdecoder_input, encoded, bdecoder_input, degree, memory_mask)
+            else:
+                bspan_decoded = self._greedy_decode_output(\
+                                           self.bspan_decoder, \
+                                           encoded, \
+                                           self.reader_.vocab.encode('EOS_Z2'),\
+                                           self.params['bspan_size'],\
+                                           memory_mask=memory_mask)
+                print('bspan dec', bspan_decoded.shape)
+                #response = self.response_decoder(concat, encoded, bspan_decoded, degree)
+                response = None# self.response_decoder(rdecoder_input, encoded, bspan_decoded, degree)
+                response_decoded = self._greedy_decode_output(\
+                                           self.response_decoder, \
+                                           encoded, \
+                                           self.reader_.vocab.encode('EOS_M'),\
+                                           cfg.max_ts, \
+                                           bspan_decoded, \
+                                           degree, \
+                                           memory_mask)
+                print(response_decoded.shape)
 
         # TODO return only response or bspan also?
         return response, response_decoded
@@ -427,34 +430,49 @@ def remove_padding(tensor, dim=-1):
 
 def init_embedding_model(model, r):
     """ Set glove embeddings for model, r is a reader instance """
-    initial_arr = model.embedding.weight.data.cpu().numpy()
-    embedding_arr = torch.from_numpy(reader.get_glove_matrix(r.vocab, initial_arr))
-    model.embedding.weight.data.copy_(embedding_arr)
+    init_embedding(model.embedding, r)
 
 def init_embedding(embedding, r):
+    """ Set glove embeddings, scaled by sqrt(embedding dim), r is a reader instance.
+    The scaling of the embeddings (before adding the positional encoding) is folded
+    into the weights here, so the forward passes are a pure lookup. """
     initial_arr = embedding.weight.data.cpu().numpy()
     embedding_arr = torch.from_numpy(reader.get_glove_matrix(r.vocab, initial_arr))
+    embedding_arr *= math.sqrt(embedding.embedding_dim)
     embedding.weight.data.copy_(embedding_arr)
     return embedding
 
+def _pad_rows(sequences, length):
+    """ Pad the id lists into a (batch, length) long tensor, one list per row """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    padded = np.zeros((len(sequences), length), dtype=np.int64)
+    padded[np.arange(length) < lengths[:, None]] = np.fromiter(
+        itertools.chain.from_iterable(sequences), dtype=np.int64, count=lengths.sum())
+    return torch.from_numpy(padded)
+
 def convert_batch(batch, params):
     # convert batch to tensors
     # yield tensors with batched inputs
     # dict_keys(['dial_id', 'turn_num', 'user', 'response', 'bspan', 'u_len', 'm_len', 'degree', 'supervised'])
 
     for turn in batch:
-        user = torch.zeros(params['user_size'],len(turn['user']), dtype=torch.long)
-        bspan = torch.zeros(params['bspan_size'],len(turn['bspan']), dtype=torch.long)
-        response = torch.zeros(params['response_size'], len(turn['response']), dtype=torch.long)
-        degree = torch.zeros(5, len(turn['degree']), dtype=torch.long)
-        for i, (u, b, r, d) in enumerate(zip(turn['user'], turn['bspan'], turn['response'], turn['degree'])):
-            user[:len(u), i] = torch.tensor(u, dtype=torch.long)
-            bspan[:len(b), i] = torch.tensor(b, dtype=torch.long)
-            response[:len(r), i] = torch.tensor(r, dtype=torch.long)
-            degree[:5,i] = torch.tensor(d, dtype=torch.long)
+        user = _pad_rows(turn['user'], params['user_size'])
+        bspan = _pad_rows(turn['bspan'], params['bspan_size'])
+        response = _pad_rows(turn['response'], params['response_size'])
+        degree = torch.from_numpy(np.array(turn['degree'], dtype=np.int64).reshape(-1, 5))
 
         yield user, bspan, response, degree
 
+def convert_dialogue_batch(batch, params):
+    """ Convert all the turns of a batch and stack them along the batch dimension.
+    The inputs of a turn do not depend on the outputs of the previous one (the previous
+    bspan is not fed to the model), so all the turns go through the model in one pass.
+
+    Returns:
+        user, bspan, response, degree, each of shape (turns * batch, seq_len)
+    """
+    return [torch.cat(turn_tensors, dim=0) for turn_tensors in zip(*convert_batch(batch, params))]
+
 
 def get_params():
     # TODO: make parameter handling great again!
@@ -486,9 +504,11 @@ def main_function(train_sequicity=True):
 
     embedding = nn.Embedding(params['ntoken'], params['ninp'])
     embedding = init_embedding(embedding, r)
+    # the sinusoid table is the same for all the modules, build it once
+    pos_encoder = PositionalEncoding(params['ninp'], params['dropout_encoder'])
 
 
-    # def __init__(self, ntoken, ninp, nhead, nhid, nlayers, reader, params, dropout=0.5, embedding=None):
+    # def __init__(self, ntoken, ninp, nhead, nhid, nlayers, reader, params, dropout=0.5, embedding=None, pos_encoder=None):
     encoder = Encoder(
         params['ntoken'],\
         params['ninp'],\
@@ -497,8 +517,9 @@ def main_function(train_sequicity=True):
         params['nlayers'],\
         params,\
         params['dropout_encoder'],\
-        embedding).to(device)
-    bspan_decoder = BSpanDecoder(
+        embedding,\
+        pos_encoder).to(device)
+    bspan_decoder = Decoder(
         params['ntoken'],\
         params['ninp'],\
         params['nhead'],\
@@ -508,8 +529,10 @@ def main_function(train_sequicity=True):
         r,\
         params,\
         params['dropout_bdecoder'],\
-        embedding).to(device)
-    response_decoder = ResponseDecoder(
+        embedding,\
+        pos_encoder,\
+        go_id=3).to(device)  # GO_2 token has index 3
+    response_decoder = Decoder(
         params['ntoken'],\
         params['ninp'],\
         params['nhead'],\
@@ -518,12 +541,16 @@ def main_function(train_sequicity=True):
         r,\
         params,\
         params['dropout_rdecoder'],\
-        embedding).to(device)
+        embedding,\
+        pos_encoder,\
+        go_id=1,\
+        unmasked=params['bspan_size'] + 1).to(device)  # we do not mask the degree, bspan and <go> token
 
     model = SequicityModel(encoder, bspan_decoder, response_decoder, params, r)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=params['lr'])
-    criterion = nn.CrossEntropyLoss()
+    # float16 training (GPUs without bfloat16, see `SequicityModel.forward`) needs loss scaling
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda' and not torch.cuda.is_bf16_supported())
 
     if train_sequicity:
         iterator = r.mini_batch_iterator('train') # bucketed by turn_num
@@ -536,31 +563,31 @@ def main_function(train_sequicity=True):
             model.train()
             print('Start epoch', epoch)
             for batch in iterator:
-                prev_bspan = None  # bspan from previous turn
-                for user, bspan, response_, degree in convert_batch(batch, params):
-                    optimizer.zero_grad()
-                    out, _  = model(user, bspan, response_, degree)
-                    # TODO what about OOV? like name_SLOT
-                    r2 = torch.cat([response_, torch.zeros((22, out.size(1)), dtype=torch.int64)])
-                    loss = criterion(out.view(-1, params['ntoken']), r2.view(-1))
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-                    optimizer.step()
-
-                    print(loss)
+                user, bspan, response_, degree = [t.to(device) for t in convert_dialogue_batch(batch, params)]
+                optimizer.zero_grad()
+                out, _  = model(user, bspan, response_, degree)
+                # TODO what about OOV? like name_SLOT
+                r2 = torch.cat([response_, response_.new_zeros((out.size(0), 22))], dim=1)
+                loss = F.cross_entropy(out.view(-1, params['ntoken']), r2.view(-1))  # log_softmax + NLL of the logits
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)  # clip the real gradients
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+                scaler.step(optimizer)
+                scaler.update()
+
+                print(loss)
 
             # TODO evaluate!!!
             model.eval()
             total_loss = 0.0
-            softmax = torch.nn.Softmax(-1)
             for batch in eval_iterator:
-                prev_bspan = None  # bspan from previous turn
-                for user, bspan, response_, degree in convert_batch(batch, params):
+                user, bspan, response_, degree = [t.to(device) for t in convert_dialogue_batch(batch, params)]
+                with torch.no_grad():
                     _, decoded = model(user, bspan, response_, degree)
-                    # TODO it just does not work
-                    for s in decoded:
-                        x = r.vocab.sentence_decode(np.array(s))
-                        print(x) # print sentences
+                # TODO it just does not work
+                for s in decoded.cpu():
+                    x = r.vocab.sentence_decode(np.array(s))
+                    print(x) # print sentences
 
 
 
@@ -573,20 +600,18 @@ def main_function(train_sequicity=True):
             torch.save(model.state_dict(), model_path)
 
     else: # test the best model
-        model.load_state_dict(torch.load("models/best_model.pt"))
+        model.load_state_dict(torch.load("models/best_model.pt", map_location=device))
         model.eval()
         iterator = r.mini_batch_iterator('test') 
         total_loss = 0.0
-        softmax = torch.nn.Softmax(-1)
         for batch in iterator:
-            prev_bspan = None  # bspan from previous turn
-
-            for user, bspan, response_, degree in convert_batch(batch, params):
+            user, bspan, response_, degree = [t.to(device) for t in convert_dialogue_batch(batch, params)]
+            with torch.no_grad():
                 _, decoded = model(user, bspan, response_, degree)  # decoded are autoregressively decoded sentences
-                # TODO it just does not work
-                for s in decoded:
-                    x = r.vocab.sentence_decode(np.array(s))
-                    print(x) # print sentences
+            # TODO it just does not work
+            for s in decoded.cpu():
+                x = r.vocab.sentence_decode(np.array(s))
+                print(x) # print sentences
 
         print("Total loss on test dataset:", total_loss)
 
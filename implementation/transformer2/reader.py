@@ -1,4 +1,6 @@
 import numpy as np
+import functools
+import hashlib
 import json
 import pickle
 from config import global_config as cfg
@@ -829,36 +831,65 @@ def pad_sequences(sequences, maxlen=None, dtype='int32', padding='pre', truncati
     return x
 
 
+@functools.lru_cache(maxsize=4)
+def _load_glove(glove_path):
+    """ Parse a GloVe text file once per process, return a dict word -> np.float32 vector """
+    glove = {}
+    with open(glove_path, 'r') as ef:
+        for line in ef:
+            line = line.strip().split(' ')
+            glove[line[0]] = np.array(line[1:], np.float32)
+    return glove
+
+
+def _glove_hits_path(vocab, embedding_size):
+    """ Path of the saved glove vectors of `vocab`, the name contains a hash of the vocabulary
+    and of the glove file, so a changed vocabulary never picks up stale vectors """
+    words = '\n'.join(vocab.decode(i) for i in range(len(vocab)))
+    digest = hashlib.md5('{}\n{}'.format(os.path.basename(cfg.glove_path), words).encode('utf-8')).hexdigest()[:8]
+    vocab_name = os.path.splitext(os.path.basename(cfg.vocab_path))[0]
+    return os.path.join(os.path.dirname(cfg.vocab_path), 'glove-{}-{}-{}.npz'.format(vocab_name, embedding_size, digest))
+
+
 def get_glove_matrix(vocab, initial_embedding_np):
     """
     return a glove embedding matrix
+    the rows of the words found in glove (indices and vectors) are saved next to the vocabulary
+    on the first build and loaded by later calls (and runs), the other rows are kept from
+    `initial_embedding_np`
     :param self:
     :param glove_file:
     :param initial_embedding_np:
     :return: np array of [V,E]
     """
-    ef = open(cfg.glove_path, 'r')
-    cnt = 0
-    vec_array = initial_embedding_np
+    vec_array = initial_embedding_np.astype(np.float32)
+    hits_path = _glove_hits_path(vocab, vec_array.shape[1])
+    if os.path.exists(hits_path):
+        logging.info('loading glove embedding vectors from %s' % hits_path)
+        with np.load(hits_path) as hits:
+            vec_array[hits['indices']] = hits['vectors']
+        return vec_array
+
     old_avg = np.average(vec_array)
     old_std = np.std(vec_array)
-    vec_array = vec_array.astype(np.float32)
+    cnt = 0
     new_avg, new_std = 0, 0
 
-    for line in ef.readlines():
-        line = line.strip().split(' ')
-        word, vec = line[0], line[1:]
-        vec = np.array(vec, np.float32)
+    hits = {}  # word index -> vector, a later word of the same index (<unk>) overrides
+    for word, vec in _load_glove(cfg.glove_path).items():
         word_idx = vocab.encode(word)
         if word.lower() in ['unk', '<unk>'] or word_idx != vocab.encode('<unk>'):
             cnt += 1
-            vec_array[word_idx] = vec
+            hits[word_idx] = vec
             new_avg += np.average(vec)
             new_std += np.std(vec)
     new_avg /= cnt
     new_std /= cnt
-    ef.close()
     logging.info('%d known embedding. old mean: %f new mean %f, old std %f new std %f' % (cnt, old_avg, new_avg, old_std, new_std))
+    indices = np.fromiter(hits, dtype=np.int64, count=len(hits))
+    vectors = np.stack(list(hits.values())).astype(np.float32)
+    vec_array[indices] = vectors
+    np.savez(hits_path, indices=indices, vectors=vectors)
     return vec_array
 
 def cuda_(var):